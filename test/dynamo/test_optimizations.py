@@ -11,7 +11,10 @@ import torchdynamo
 from torchdynamo.optimizations import backends
 from torchdynamo.optimizations.analysis import has_mutation
 from torchdynamo.optimizations.log_args import conv_args_analysis
+from torchdynamo.optimizations.normalize import MODULE_LOWERINGS
+from torchdynamo.optimizations.normalize import MODULE_TRACE_CACHE
 from torchdynamo.optimizations.normalize import Inplacifier
+from torchdynamo.optimizations.normalize import expand_module_call
 from torchdynamo.optimizations.normalize import normalize
 from torchdynamo.testing import same
 
@@ -75,6 +78,91 @@ class TestOptimizations(torchdynamo.testing.TestCase):
         self.assertIn("inplace=True", code)
         self.assertIn("out=linear_1", code)
 
+    def test_normalize_reuses_traces(self):
+        class Blocks(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.a = torch.nn.Sequential(
+                    torch.nn.Linear(10, 10), torch.nn.LeakyReLU(0.1)
+                )
+                self.b = torch.nn.Sequential(
+                    torch.nn.Linear(10, 10), torch.nn.LeakyReLU(0.1)
+                )
+                self.c = torch.nn.Sequential(
+                    torch.nn.Linear(10, 10), torch.nn.LeakyReLU(0.5)
+                )
+
+            def forward(self, x):
+                return self.c(self.b(self.a(x)))
+
+        model = Blocks()
+        x = torch.randn(4, 10)
+        gm = torch.fx.symbolic_trace(model)
+        MODULE_TRACE_CACHE.clear()
+        normalize(gm)
+        gm.recompile()
+        self.assertTrue(same(model(x), gm(x)))
+        # Linear is lowered directly, a.1 and b.1 share a trace, c.1 differs
+        self.assertEqual(len(MODULE_TRACE_CACHE), 2)
+
+        torchdynamo.reset()
+        self.assertEqual(len(MODULE_TRACE_CACHE), 0)
+
+    def test_normalize_tied_weights(self):
+        class Pair(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.a = torch.nn.Linear(10, 10)
+                self.b = torch.nn.Linear(10, 10)
+
+            def forward(self, x):
+                return self.b(self.a(x))
+
+        class PairLeafTracer(torch.fx.Tracer):
+            def is_leaf_module(self, m, module_qualified_name):
+                return isinstance(m, Pair) or super().is_leaf_module(
+                    m, module_qualified_name
+                )
+
+        x = torch.randn(4, 10)
+        MODULE_TRACE_CACHE.clear()
+        for tied in (True, False):
+            model = torch.nn.Sequential(Pair())
+            if tied:
+                model[0].b.weight = model[0].a.weight
+            gm = torch.fx.GraphModule(model, PairLeafTracer().trace(model))
+            normalize(gm)
+            gm.recompile()
+            self.assertTrue(same(model(x), gm(x)))
+        self.assertEqual(len(MODULE_TRACE_CACHE), 2)
+
+    def test_module_lowerings_match_tracing(self):
+        def describe(graph):
+            index = {n: i for i, n in enumerate(graph.nodes)}
+            return [
+                (n.op, n.target, torch.fx.map_arg((n.args, n.kwargs), index.get))
+                for n in graph.nodes
+            ]
+
+        for module in (
+            torch.nn.Linear(10, 10, bias=False),
+            torch.nn.ReLU(inplace=True),
+            torch.nn.SiLU(),
+            torch.nn.Tanh(),
+        ):
+            self.assertIn(type(module), MODULE_LOWERINGS)
+            gm = torch.fx.symbolic_trace(torch.nn.Sequential(module))
+            placeholder = next(iter(gm.graph.nodes)).target
+            normalize(gm)
+
+            traced = torch.fx.Graph()
+            traced.output(
+                expand_module_call(
+                    "0.", traced, module, (traced.placeholder(placeholder),), {}
+                )
+            )
+            self.assertEqual(describe(gm.graph), describe(traced))
+
     def test_has_mutation(self):
         gm = torch.fx.symbolic_trace(Seq())
         self.assertFalse(has_mutation(gm, torch.rand([10, 10])))
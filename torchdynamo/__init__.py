@@ -45,6 +45,10 @@ def reset():
     eval_frame.most_recent_backend = None
     compilation_metrics.clear()
 
+    from .optimizations import normalize
+
+    normalize.MODULE_TRACE_CACHE.clear()
+
 
 def list_backends():
     """
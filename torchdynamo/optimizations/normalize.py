@@ -1,4 +1,5 @@
 import builtins
+import collections
 import dataclasses
 import functools
 import itertools
@@ -10,6 +11,7 @@ import torch
 from torch.fx import Transformer
 from torch.fx.experimental.normalize import NormalizeOperators
 from torch.fx.operator_schemas import get_signature_for_torch_op
+from torch.fx.proxy import Scope
 
 from .. import config
 from ..allowed_functions import torch_get_name
@@ -125,21 +127,23 @@ DONT_EXPAND_MODULES = {
 }
 
 F = torch.nn.functional
-INPLACE_KEYWORD_OPS = {
-    F.mish,
-    F.silu,
-    F.hardsigmoid,
-    F.rrelu,
-    F.leaky_relu,
-    F.celu,
-    F.selu,
-    F.elu,
-    F.relu6,
-    F.hardswish,
-    F.hardtanh,
-    F.relu,
-    F.threshold,
-}
+INPLACE_KEYWORD_OPS = frozenset(
+    {
+        F.mish,
+        F.silu,
+        F.hardsigmoid,
+        F.rrelu,
+        F.leaky_relu,
+        F.celu,
+        F.selu,
+        F.elu,
+        F.relu6,
+        F.hardswish,
+        F.hardtanh,
+        F.relu,
+        F.threshold,
+    }
+)
 IOPERATOR_REPLACEMENTS = {
     "masked_fill_": "masked_fill",
     "scatter_": "scatter",
@@ -185,13 +189,18 @@ OPERATOR_REPLACEMENTS = {
     torch.nn.functional.relu: torch.relu,
 }
 
-SKIP_INPLACE = {
+SKIP_INPLACE = frozenset(
     v
     for v in itertools.chain(
         math.__dict__.values(), builtins.__dict__.values(), operator.__dict__.values()
     )
     if callable(v)
-}
+)
+
+
+@functools.lru_cache(None)
+def _dont_expand(cls):
+    return cls.__name__ in DONT_EXPAND_MODULES
 
 
 def always_true(*args, **kwargs):
@@ -202,15 +211,108 @@ class InliningTracer(torch.fx.Tracer):
     def is_leaf_module(self, m: torch.nn.Module, module_qualified_name: str) -> bool:
         return False
 
+    def reset(self):
+        """
+        trace() reinitializes the graph and tensor_attrs, but not the scope
+        tracking set up in Tracer.__init__, and module_stack isn't popped if
+        tracing fails.  Clear it so stale nn_module_stack entries don't leak
+        into the next trace.
+        """
+        self.root = self.graph = None
+        self.scope = Scope("", None)
+        self.module_stack = collections.OrderedDict()
+        self.node_name_to_scope = dict()
+
+
+# Shared across expansions, reset() after every trace
+_INLINING_TRACER = InliningTracer()
+
+
+# Traced graphs of expanded modules, keyed by _trace_cache_key().
+# Cleared by torchdynamo.reset()
+MODULE_TRACE_CACHE = dict()
+_CONSTANT_TYPES = (type(None), bool, int, float, str, torch.dtype, torch.device)
+
+
+def _attr_structure(value):
+    if isinstance(value, _CONSTANT_TYPES):
+        return type(value), value
+    elif isinstance(value, (tuple, list)):
+        return type(value), tuple(map(_attr_structure, value))
+    elif isinstance(value, dict):
+        return type(value), tuple(
+            (_attr_structure(k), _attr_structure(v)) for k, v in value.items()
+        )
+    elif isinstance(value, set):
+        return type(value), frozenset(map(_attr_structure, value))
+    raise TypeError(f"unsupported module attribute {type(value)}")
+
+
+def _first_path(memo, value, path):
+    # The tracer names a tied parameter/buffer/submodule by the first path it
+    # appears at, so the key has to capture which entries alias each other.
+    if value is None:
+        return None
+    return memo.setdefault(id(value), path)
+
+
+def _module_structure(module, memo, prefix):
+    state = []
+    for name, value in module.__dict__.items():
+        if name in ("_parameters", "_buffers"):
+            # only names and aliasing matter, tracing turns these into get_attr
+            value = tuple(
+                (k, _first_path(memo, v, f"{prefix}{k}")) for k, v in value.items()
+            )
+        elif name == "_modules":
+            children = []
+            for k, v in value.items():
+                path = f"{prefix}{k}"
+                first = _first_path(memo, v, path)
+                if first == path:
+                    children.append((k, _module_structure(v, memo, f"{path}.")))
+                else:
+                    children.append((k, first))
+            value = tuple(children)
+        else:
+            value = _attr_structure(value)
+        state.append((name, value))
+    return type(module), tuple(state)
 
-def expand_module_call(prefix, graph: torch.fx.Graph, module, args, kwargs):
+
+def _trace_cache_key(module):
+    # Modules with equal keys trace to the same graph.  Returns None if
+    # `module` holds state (hooks, tensors, arbitrary objects) we can't compare.
+    try:
+        return _module_structure(module, {id(module): ""}, "")
+    except TypeError:
+        return None
+
+
+def _trace_module(module, key):
+    if key is not None and key in MODULE_TRACE_CACHE:
+        return MODULE_TRACE_CACHE[key]
     # this patch is needed to make BatchNorm2D FX trace
     module.__dict__["_check_input_dim"] = always_true
+    try:
+        attrs = set(module.__dict__)
+        traced = _INLINING_TRACER.trace(module)
+        # tracing can stash constants (e.g. _tensor_constant0) on the module,
+        # which other instances won't have
+        if key is not None and set(module.__dict__) == attrs:
+            MODULE_TRACE_CACHE[key] = traced
+        return traced
+    finally:
+        del module.__dict__["_check_input_dim"]
+        _INLINING_TRACER.reset()
+
+
+def expand_module_call(prefix, graph: torch.fx.Graph, module, args, kwargs):
     try:
         assert not kwargs
         arg_index = itertools.count()
         vars = dict()
-        for node in InliningTracer().trace(module).nodes:
+        for node in _trace_module(module, _trace_cache_key(module)).nodes:
             if node.op == "placeholder":
                 vars[node] = args[next(arg_index)]
             elif node.op == "output":
@@ -224,8 +326,45 @@ def expand_module_call(prefix, graph: torch.fx.Graph, module, args, kwargs):
     except Exception:
         print(f"Error while expanding {module.__class__.__name__}")
         raise
-    finally:
-        del module.__dict__["_check_input_dim"]
+
+
+def _lower_linear(prefix, graph: torch.fx.Graph, module, args):
+    weight = graph.get_attr(f"{prefix}weight")
+    bias = None if module.bias is None else graph.get_attr(f"{prefix}bias")
+    return graph.call_function(F.linear, (*args, weight, bias))
+
+
+def _lower_inplace_activation(fn):
+    def lower(prefix, graph: torch.fx.Graph, module, args):
+        return graph.call_function(fn, args, {"inplace": module.inplace})
+
+    return lower
+
+
+def _lower_activation(fn):
+    def lower(prefix, graph: torch.fx.Graph, module, args):
+        return graph.call_function(fn, args)
+
+    return lower
+
+
+# Emit the same nodes expand_module_call() would trace for these leaf
+# modules, without running the tracer.  Only exact types are matched.
+MODULE_LOWERINGS = {
+    torch.nn.Linear: _lower_linear,
+    torch.nn.ReLU: _lower_inplace_activation(F.relu),
+    torch.nn.SiLU: _lower_inplace_activation(F.silu),
+    torch.nn.Sigmoid: _lower_activation(torch.sigmoid),
+    torch.nn.Tanh: _lower_activation(torch.tanh),
+}
+
+
+@functools.lru_cache(None)
+def _supports_out(target):
+    return any(
+        "out" in sig.parameters and sig.parameters["out"].annotation is torch.Tensor
+        for sig in get_signature_for_torch_op(target) or ()
+    )
 
 
 @dataclasses.dataclass
@@ -247,78 +386,80 @@ def short_name(gm, node: torch.fx.Node):
     assert False, node.op
 
 
+@functools.lru_cache(None)
+def _function_long_name(target):
+    return torch_get_name(
+        target, f"{getattr(target, '__module__', '')}.{target.__name__}"
+    )
+
+
 def long_name(gm, node: torch.fx.Node):
-    name = short_name(gm, node)
-    target = node.target
     if node.op == "call_function":
-        return torch_get_name(
-            node.target, f"{getattr(target, '__module__', '')}.{name}"
-        )
-    elif node.op == "call_method":
-        return name
+        return _function_long_name(node.target)
     elif node.op == "call_module":
-        target = gm.get_submodule(target).__class__
+        target = gm.get_submodule(node.target).__class__
         return f"{getattr(target, '__module__', '')}.{getattr(target, '__name__', '')}"
-    elif node.op == "get_attr":
-        return name
-    elif node.op == "output":
-        return "output"
-    assert False
+    return short_name(gm, node)
 
 
 class Inplacifier:
     def __init__(self, gm: torch.fx.GraphModule):
         self.gm = gm
+        # short_name() walks get_submodule() for call_module, so compute once
+        self._short_names = {
+            n: short_name(gm, n)
+            for n in gm.graph.nodes
+            if n.op in ("call_function", "call_method", "call_module")
+        }
 
     def can_be_view(self, node):
-        name = short_name(self.gm, node)
+        name = self._short_names[node]
         return name in VIEW_OPS or name in MAYBE_VIEW_OPS
 
     def inplacify(self):
         counts = dict()
 
-        def record_usage(node):
-            counts[node].usages += 1
-            return node
-
-        for node in self.gm.graph.nodes:
-            if node.op in ("call_function", "call_method", "call_module"):
-                if self.can_be_view(node):
-                    # Aliasing
-                    counts[node] = counts[node.args[0]]
-                elif "out" in node.kwargs:
-                    counts[node] = counts[node.kwargs["out"]]
+        def get_counts(node):
+            # populated lazily so we only need the single reverse pass below
+            if node not in counts:
+                if node.op in ("call_function", "call_method", "call_module"):
+                    if self.can_be_view(node):
+                        # Aliasing
+                        counts[node] = get_counts(node.args[0])
+                    elif "out" in node.kwargs:
+                        counts[node] = get_counts(node.kwargs["out"])
+                    else:
+                        counts[node] = NodeCounts(0)
                 else:
-                    counts[node] = NodeCounts(0)
-            else:
-                counts[node] = NodeCounts(float("inf"))
+                    counts[node] = NodeCounts(float("inf"))
+            return counts[node]
 
-        for node in reversed(list(self.gm.graph.nodes)):
-            kwargs = dict(node.kwargs)
+        n_inplace = n_out = 0
+        for node in reversed(self.gm.graph.nodes):
+            kwargs = node.kwargs
             if "inplace" in kwargs:
-                kwargs.pop("inplace")
+                kwargs = {k: v for k, v in kwargs.items() if k != "inplace"}
             if node.op == "call_function" and len(node.args) + len(kwargs) == 1:
-                arg = node.args[0] if node.args else next(kwargs.values())
-                if isinstance(arg, torch.fx.Node) and counts[arg].usages == 0:
+                arg = node.args[0] if node.args else next(iter(kwargs.values()))
+                if isinstance(arg, torch.fx.Node) and get_counts(arg).usages == 0:
                     if node.target in SKIP_INPLACE:
                         continue
                     elif node.target in INPLACE_KEYWORD_OPS:
-                        kwargs["inplace"] = True
-                        counters["optimizations"]["inplace"] += 1
-                    elif " out: torch.Tensor" in repr(
-                        get_signature_for_torch_op(node.target)
-                    ):
-                        kwargs["out"] = arg
-                        counters["optimizations"]["out"] += 1
+                        node.kwargs = {**kwargs, "inplace": True}
+                        n_inplace += 1
+                    elif _supports_out(node.target):
+                        node.kwargs = {**kwargs, "out": arg}
+                        n_out += 1
                     else:
                         continue
-                    with self.gm.graph.inserting_before(node):
-                        node.replace_all_uses_with(
-                            self.gm.graph.call_function(node.target, node.args, kwargs)
-                        )
-                    self.gm.graph.erase_node(node)
 
-            torch.fx.map_arg((node.args, node.kwargs), record_usage)
+            for inp in node.all_input_nodes:
+                get_counts(inp).usages += 1
+
+        if n_inplace:
+            counters["optimizations"]["inplace"] += n_inplace
+        if n_out:
+            counters["optimizations"]["out"] += n_out
 
 
 class Functionalization(Transformer):
@@ -336,27 +477,27 @@ class Functionalization(Transformer):
         target = n.target
         args, kwargs = self.fetch_args_kwargs_from_env(n)
         kwargs = dict(kwargs)
+        ioperator_replacement = IOPERATOR_REPLACEMENTS.get(n.target)
+        meta = n.meta
+        node_kwargs = n.kwargs
+        is_tensor = issubclass(meta["type"], torch.Tensor)
 
-        if (
-            not n.meta["is_input_mutation"]
-            and not n.meta["partial_mutation"]
-            and issubclass(n.meta["type"], torch.Tensor)
-        ):
-            if "inplace" in n.kwargs:
+        if not meta["is_input_mutation"] and not meta["partial_mutation"] and is_tensor:
+            if "inplace" in node_kwargs:
                 if kwargs["inplace"]:
                     patches.append(n.args[0])
                 kwargs.pop("inplace")
-            elif "out" in n.kwargs:
+            elif "out" in node_kwargs:
                 kwargs.pop("out")
-                patches.append(n.kwargs["out"])
-            elif n.target in IOPERATOR_REPLACEMENTS:
-                target = IOPERATOR_REPLACEMENTS[n.target]
+                patches.append(node_kwargs["out"])
+            elif ioperator_replacement is not None:
+                target = ioperator_replacement
                 patches.append(n.args[0])
-            elif n.meta["is_mutation"]:
+            elif meta["is_mutation"]:
                 counters["mutation"][long_name(self.module, n)] += 1
 
-            if target in OPERATOR_REPLACEMENTS and not kwargs:
-                target = OPERATOR_REPLACEMENTS[target]
+            if not kwargs:
+                target = OPERATOR_REPLACEMENTS.get(target, target)
 
         if target is builtins.getattr:
             if args[1] == "dtype":
@@ -371,7 +512,7 @@ class Functionalization(Transformer):
             kwargs.update(target.keywords)
             target = target.func
 
-        if not issubclass(n.meta["type"], torch.Tensor):
+        if not is_tensor:
             counters["nontensor"][long_name(self.module, n)] += 1
 
         with self._set_current_node(n):
@@ -379,7 +520,7 @@ class Functionalization(Transformer):
 
             # For inplace operators, the output dtype should be equal to the
             # dtype of tensor being inplace modified.
-            if n.target in IOPERATOR_REPLACEMENTS:
+            if ioperator_replacement is not None:
                 result = getattr(self, "call_method")(
                     "to", (result, n.args[0].meta["dtype"]), {}
                 )
@@ -403,27 +544,41 @@ def swap_node(graph, old_node, new_node):
 def normalize(gm: torch.fx.GraphModule):
     # gm.graph.print_tabular()
     graph: torch.fx.Graph = gm.graph
-
-    for node in list(graph.nodes):
+    submodules = dict(gm.named_modules(remove_duplicate=False))
+
+    call_method_nodes = []
+    call_module_nodes = []
+    for node in graph.nodes:
+        if node.op == "call_method":
+            call_method_nodes.append(node)
+        elif node.op == "call_module":
+            call_module_nodes.append(node)
+
+    for node in call_method_nodes:
+        new_target = NORMALIZE_METHODS.get(node.target)
+        if new_target is not None:
+            # x.foo(...) -> torch.foo(x, ...) keeps args, kwargs and users
+            node.op = "call_function"
+            node.target = new_target
+
+    for node in call_module_nodes:
+        submod = submodules[node.target]
+        lowering = MODULE_LOWERINGS.get(type(submod))
         with graph.inserting_before(node):
-            if node.op == "call_method" and node.target in NORMALIZE_METHODS:
+            if lowering is not None and not node.kwargs:
+                swap_node(
+                    graph,
+                    node,
+                    lowering(f"{node.target}.", graph, submod, node.args),
+                )
+            elif not _dont_expand(type(submod)):
                 swap_node(
                     graph,
                     node,
-                    graph.call_function(
-                        NORMALIZE_METHODS[node.target], node.args, node.kwargs
+                    expand_module_call(
+                        f"{node.target}.", graph, submod, node.args, node.kwargs
                     ),
                 )
-            elif node.op == "call_module":
-                submod = gm.get_submodule(node.target)
-                if submod.__class__.__name__ not in DONT_EXPAND_MODULES:
-                    swap_node(
-                        graph,
-                        node,
-                        expand_module_call(
-                            f"{node.target}.", graph, submod, node.args, node.kwargs
-                        ),
-                    )
 
     # gm.graph.print_tabular()
 